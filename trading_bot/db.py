@@ -5,7 +5,7 @@ import getpass
 import uuid
 from datetime import datetime
 from types import TracebackType
-from typing import Optional, Iterable, Sequence, AsyncGenerator, Type
+from typing import Any, Optional, Iterable, Sequence, AsyncGenerator, Type
 
 import codetiming
 import psycopg
@@ -16,11 +16,17 @@ import sqlalchemy.exc
 from psycopg.abc import Buffer
 from sqlalchemy import ForeignKey
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncSession
-from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
+from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship, selectinload
 from sqlalchemy.types import Text
 
 import logger
 
+_STREAM_BATCH_SIZE = 1000  # rows of a streamed ORM result loaded at a time
+HISTORY_WRITERS = 4  # concurrent candle history writes, each on its own bulk connection
+_POOL_MIN_SIZE = HISTORY_WRITERS  # bulk connections kept open
+_POOL_MAX_SIZE = 16  # with the concurrent instrument saves on top
+_POOL_CLOSE_TIMEOUT = 10  # seconds to wait for the pool workers on disconnect
+
 
 # region Database schema
 
@@ -121,19 +127,38 @@ class Split(Base):
     def __repr__(self) -> str:
         return f'{self.instrument_id:05} {self.timestamp:%Y-%m-%d %H:%M} ({self.ratio})'
 
+# Instrument columns filled from the API: all but the generated ID and the asset type
+instrument_fields: tuple[str, ...] = tuple(key for key in sa.inspect(Instrument).columns.keys()
+                                           if key not in (Instrument.id.key, Instrument.asset_type_id.key))
+
 # endregion Database schema
 
 
+def _compile_instrument_upsert(dialect: sa.Dialect) -> str:
+    # Compiled once to the driver's SQL, so that each call doesn't rebuild and compile the statement.
+    stmt = pg.insert(Instrument.__table__)
+    updated_data = {column.name: column for column in stmt.excluded if not column.primary_key}
+    stmt = stmt.on_conflict_do_update(index_elements=[Instrument.uid], set_=updated_data)
+    return str(stmt.compile(dialect=dialect,
+                            column_keys=[*instrument_fields, Instrument.asset_type_id.name],
+                            for_executemany=True))
+
+
 class DB:
     _engine = create_async_engine(sa.URL.create(
         drivername='postgresql+psycopg',
         username=getpass.getuser(),
         database='trading_bot'),
-        echo=False)
+        echo=False,
+        pool_recycle=3600,
+        connect_args={
+            'application_name': 'trading_bot',  # to tell the connections apart in pg_stat_activity
+        })
     _start_session: async_sessionmaker[AsyncSession] = async_sessionmaker(_engine, class_=AsyncSession, expire_on_commit=False)
     _asset_types_lock = asyncio.Lock()
-    _asset_types: Optional[dict[str, AssetType]] = None
+    _asset_types: Optional[dict[str, int]] = None  # IDs by names, static after create()
     _pg_pool: psycopg_pool.AsyncConnectionPool
+    _instrument_upsert_sql = _compile_instrument_upsert(_engine.dialect)
 
 
     async def __aenter__(self) -> DB:
@@ -151,11 +176,22 @@ class DB:
 
 
     async def connect(self) -> None:
-        self._pg_pool = psycopg_pool.AsyncConnectionPool(f'dbname={self._engine.url.database} user={self._engine.url.username}')
+        # Bulk data can be downloaded again, so its commits don't wait for a WAL flush. A server crash can only lose
+        # the latest commits; as the candles of an instrument are committed in order (see Host.download_history()),
+        # only the end of its history can be lost, and the next run resumes from its last saved candle.
+        # Connected in the background right away, so that the first writers find the connections ready.
+        # Not waited for: before the first create() the database doesn't exist, and the pool keeps retrying until it does.
+        self._pg_pool = psycopg_pool.AsyncConnectionPool(f'dbname={self._engine.url.database} user={self._engine.url.username} '
+                                                         f'application_name=trading_bot.bulk',
+                                                         min_size=_POOL_MIN_SIZE,
+                                                         max_size=_POOL_MAX_SIZE,
+                                                         open=False,
+                                                         kwargs={'options': '-c synchronous_commit=off'})
+        await self._pg_pool.open()
 
 
     async def disconnect(self) -> None:
-        await self._pg_pool.close()
+        await self._pg_pool.close(timeout=_POOL_CLOSE_TIMEOUT)
         await self._engine.dispose()
         logger.debug("Psycopg engine disposed.")
 
@@ -182,15 +218,25 @@ class DB:
 
             # Static data
             values = [{'name': name} for name in asset_types]
+            stmt = pg.insert(AssetType)
+            # A no-op update instead of DO NOTHING returns the existing rows too, filling the cache in the same query.
+            stmt = stmt.on_conflict_do_update(index_elements=[AssetType.name], set_={AssetType.name.key: stmt.excluded.name})\
+                .returning(AssetType.id, AssetType.name)
             async with self._start_session() as session:
-                await session.execute(pg.insert(AssetType).on_conflict_do_nothing(), values)
+                response = await session.execute(stmt, values)
+                self._asset_types = {name: asset_type_id for asset_type_id, name in response}
                 await session.commit()
 
+
+    def invalidate_asset_types(self) -> None:
+        """ Drop the cached asset types, so that they are read from the database on the next use. """
         self._asset_types = None
 
 
-    async def _get_asset_types(self) -> dict[str, AssetType]:
-        # Update and return asset types by their IDs.
+    async def _get_asset_types(self) -> dict[str, int]:
+        # Read once and return asset type IDs by their names.
+        if self._asset_types is not None:  # the dict is replaced, never modified, so no lock is needed to read it
+            return self._asset_types
         async with self._asset_types_lock:
             if self._asset_types is not None:
                 return self._asset_types
@@ -201,56 +247,104 @@ class DB:
             return self._asset_types
 
 
-    async def add_instruments(self, asset_type: str, instruments: Sequence[Instrument]) -> None:
+    async def add_instruments(self, asset_type: str, instruments: Sequence[dict[str, Any]]) -> None:
         """ Add new instruments (of the same type) to the database.
 
         :param asset_type: The type of the instruments
-        :param instruments: DB instrument objects
+        :param instruments: Instrument column values by the keys in instrument_fields; the asset type is added in place
         """
         asset_types = await self._get_asset_types()
-        asset_type_field = {Instrument.asset_type_id.key: asset_types[asset_type]}
-        instrument_data = [vars(instrument) | asset_type_field for instrument in instruments]
-        stmt = pg.insert(Instrument)
-        updated_data = {column.name: column for column in stmt.excluded if not column.primary_key}
-        stmt = stmt.on_conflict_do_update(index_elements=[Instrument.uid], set_=updated_data)
-        with codetiming.Timer(text=lambda elapsed: f"Saved {len(instrument_data)} {asset_type} in {elapsed:.2f}s.", logger=logger.debug):
-            async with self._start_session() as session:
-                await session.execute(stmt, instrument_data)
-                await session.commit()
+        asset_type_id = asset_types[asset_type]
+        for instrument in instruments:
+            # Keyed by the column name, not the ORM attribute, as the statement runs without the ORM.
+            instrument[Instrument.asset_type_id.name] = asset_type_id
+        with codetiming.Timer(text=lambda elapsed: f"Saved {len(instruments)} {asset_type} in {elapsed:.2f}s.", logger=logger.debug):
+            async with self._pg_pool.connection() as connection:
+                # executemany() sends the rows in pipeline mode, without waiting for each response.
+                async with connection.cursor() as cursor:
+                    await cursor.executemany(self._instrument_upsert_sql, instruments)
+                await connection.commit()
 
 
-    async def get_history_endings(self, figis: Optional[Iterable[str]] = None) -> AsyncGenerator[tuple[Instrument, datetime]]:
-        """ Get the last candle timestamp for each instrument.
+    async def get_history_endings(self, figis: Optional[Iterable[str]] = None) -> AsyncGenerator[tuple[Instrument, int]]:
+        """ Get the year of the last candle for each instrument.
 
         :param figis: List of instrument FIGIs to request. None means all known instruments with a FIGI.
         """
-        subquery = sa.select(Candle.instrument_id,
-                             sa.func.max(Candle.timestamp).label('latest'))\
-            .group_by(Candle.instrument_id)\
-            .subquery()
-        query = sa.select(Instrument,
-                          sa.func.coalesce(subquery.c.latest, Instrument.first_1min_candle_date).label('history_end'))\
-            .join(subquery, Instrument.id == subquery.c.instrument_id, isouter=True)\
+        # Per instrument, the primary key index gives the latest timestamp right away,
+        # whereas grouping would scan the whole candle table.
+        latest = sa.select(sa.func.max(Candle.timestamp))\
+            .where(Candle.instrument_id == Instrument.id)\
+            .scalar_subquery()
+        history_end = sa.func.coalesce(latest, Instrument.first_1min_candle_date)
+        # Only the year is needed, no need to transfer and parse the timestamps.
+        # The asset types are selectin-loaded by one more query per batch of rows, instead of raising on access.
+        # Ordered by the label, so that the subquery isn't repeated in ORDER BY.
+        history_end_year = sa.cast(sa.extract('year', history_end), sa.Integer).label('history_end_year')
+        query = sa.select(Instrument, history_end_year)\
             .where((Instrument.figi != None) & (Instrument.first_1min_candle_date != None))\
-            .order_by('history_end')
+            .order_by(history_end_year)\
+            .options(selectinload(Instrument.asset_type_ref))\
+            .execution_options(yield_per=_STREAM_BATCH_SIZE)
+        if figis is not None:
+            query = query.where(Instrument.figi.in_(tuple(figis)))
+
+        # Streamed in batches, so that the caller can start on the first instruments while the rest are being received
+        async with self._start_session() as session:
+            with codetiming.Timer(initial_text="Requesting history endings...",
+                                  text="History endings started arriving in {:.2f}s.",
+                                  logger=logger.debug):
+                response = await session.stream(query)
+            async for instrument, history_end_year in response:
+                yield instrument, history_end_year
+
+
+    async def save_candle_history(self, csv: Buffer, fast: bool = False) -> None:
+        """ Save candles from a history CSV, skipping the existing ones.
+
+        :param csv: Candle history CSV with instrument IDs instead of UIDs and without the trailing semicolons
+        :param fast: The caller guarantees that none of the candles exist yet, so they are copied straight to the table.
+        """
+        with codetiming.Timer(text=lambda elapsed: f"Saved {len(csv) / 1024 / 1024:.2f} MB of candles in {elapsed:.2f}s.",
+                              logger=logger.debug_timer()):
+            async with self._pg_pool.connection() as connection:
+                async with connection.cursor() as cursor:
+                    # The CSVs are copied as text: parsing them in Python for a binary COPY (see save_candles())
+                    # would cost more than the server's CSV parser.
+                    if fast:
+                        async with cursor.copy("COPY candle(instrument, timestamp, open, close, high, low, volume) FROM STDIN CSV DELIMITER ';'") as copy:
+                            await copy.write(csv)
+                    else:
+                        temp_table = "candle_" + str(uuid.uuid4().hex)[:56]
+                        await cursor.execute(f'CREATE TEMP TABLE {temp_table} (LIKE candle) ON COMMIT DROP')
+                        async with cursor.copy(f"COPY {temp_table}(instrument, timestamp, open, close, high, low, volume) FROM STDIN CSV DELIMITER ';'") as copy:
+                            await copy.write(csv)
+                        # The temp table is not WAL-logged and has no indexes; merging it in key order
+                        # keeps the primary key insertions sequential.
+                        await cursor.execute(f'INSERT INTO candle SELECT * FROM {temp_table} ORDER BY instrument, timestamp '
+                                             f'ON CONFLICT (instrument, timestamp) DO NOTHING')
+                await connection.commit()
 
-        with codetiming.Timer(initial_text="Requesting history endings...",
-                              text="Received history endings in {:.2f}s.",
-                              logger=logger.debug):
-            async with self._start_session() as session:
-                response = await session.execute(query)
 
-        for instrument, history_end in response:
-            if figis is None or instrument.figi in figis:
-                yield instrument, history_end
+    async def save_candles(self, candles: Iterable[tuple[int, datetime, float, float, float, float, int]]) -> None:
+        """ Save candles, updating the existing ones.
 
-    async def save_candle_history(self, csv: Buffer) -> None:
+        :param candles: Tuples of instrument ID, timestamp, open, close, high, low, volume
+        """
         temp_table = "candle_" + str(uuid.uuid4().hex)[:56]
-        with codetiming.Timer(text=f"Saved {len(csv) / 1024 / 1024:.2f} MB of candles in {{:.2f}} s"):
+        count = 0
+        with codetiming.Timer(text=lambda elapsed: f"Saved {count} candles in {elapsed:.2f}s.", logger=logger.debug):
             async with self._pg_pool.connection() as connection:
                 async with connection.cursor() as cursor:
                     await cursor.execute(f'CREATE TEMP TABLE {temp_table} (LIKE candle) ON COMMIT DROP')
-                    async with cursor.copy(f"COPY {temp_table}(instrument, timestamp, open, close, high, low, volume) FROM STDIN CSV DELIMITER ';'") as copy:
-                        await copy.write(csv)
-                    await cursor.execute(f'INSERT INTO candle SELECT * FROM {temp_table} ON CONFLICT DO NOTHING')
+                    # Binary format skips text formatting and parsing of the values on both ends.
+                    async with cursor.copy(f"COPY {temp_table}(instrument, timestamp, open, close, high, low, volume) FROM STDIN (FORMAT BINARY)") as copy:
+                        copy.set_types(['int4', 'timestamp', 'float8', 'float8', 'float8', 'float8', 'int4'])
+                        for candle in candles:
+                            await copy.write_row(candle)
+                            count += 1
+                    await cursor.execute(f'INSERT INTO candle SELECT * FROM {temp_table} ORDER BY instrument, timestamp '
+                                         f'ON CONFLICT (instrument, timestamp) DO UPDATE SET '
+                                         f'open = EXCLUDED.open, close = EXCLUDED.close, high = EXCLUDED.high, '
+                                         f'low = EXCLUDED.low, volume = EXCLUDED.volume')
                 await connection.commit()
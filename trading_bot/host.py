@@ -1,9 +1,10 @@
 from __future__ import annotations
 
 import asyncio
+import operator
 from datetime import datetime
 from types import TracebackType
-from typing import Optional, Iterable, Type
+from typing import Any, Optional, Iterable, Sequence, Type
 
 import codetiming
 import tinkoff.invest as ti
@@ -12,6 +13,33 @@ import db
 import logger
 import tinkoff_api as tapi
 
+_HISTORY_BATCH_SIZE = 8 << 20  # bytes of candle CSVs saved in one go
+_HISTORY_DOWNLOADERS = tapi.HISTORY_CONNECTIONS  # concurrent instrument downloads, one request in flight each
+_HISTORY_SAVERS = db.HISTORY_WRITERS  # concurrent candle history writes
+_HISTORY_SAVE_QUEUE_SIZE = 32  # downloaded CSVs waiting to be saved, for all writers; downloads pause when it's full
+
+
+def _api_to_db_datetime(dt: Optional[datetime]) -> Optional[datetime]:
+    # Clear timezone info, return None instead of 1970.01.01
+    return dt.replace(tzinfo=None) if dt and dt.timestamp() else None
+
+
+def _api_to_db_instruments(api_instruments: Sequence[ti.schemas.Instrument]) -> list[dict[str, Any]]:
+    # Convert Tinkoff API instruments of one type to DB column values, without creating ORM objects: one dict per instrument.
+    if not api_instruments:
+        return []
+    # The fields the type has are read in one C call. Every key is present, as the upsert parameters are named:
+    # the fields the type lacks (options have no FIGI) are None.
+    fields = tuple(field for field in db.instrument_fields if hasattr(api_instruments[0], field))
+    get_fields = operator.attrgetter(*fields)
+    missing_fields = dict.fromkeys(field for field in db.instrument_fields if field not in fields)
+    db_instruments = [dict(zip(fields, get_fields(api_instrument)), **missing_fields)
+                      for api_instrument in api_instruments]
+    for db_instrument in db_instruments:
+        db_instrument['first_1min_candle_date'] = _api_to_db_datetime(db_instrument['first_1min_candle_date'])
+        db_instrument['first_1day_candle_date'] = _api_to_db_datetime(db_instrument['first_1day_candle_date'])
+    return db_instruments
+
 
 class Host:
     _db = db.DB()
@@ -36,6 +64,7 @@ class Host:
 
 
     async def stop(self):
+        await tapi.close()
         await self._db.disconnect()
 
 
@@ -44,28 +73,31 @@ class Host:
         await self._db.create(tapi.asset_types)
 
 
-    async def update_instruments(self, asset_types: Optional[Iterable[str]] = None) -> None:
-        """ Update the instrument info asynchronously. """
+    async def update_instruments(self, asset_types: Optional[Iterable[str]] = None, full: bool = True) -> None:
+        """ Update the instrument info asynchronously.
+
+        :param asset_types: Asset types to update; None to update all.
+        :param full: Fetch all instruments; False to fetch only the ones tradable via the API, enough for a regular refresh.
+        """
 
-        def api_to_db_instrument(api_instrument: ti.schemas.Instrument) -> db.Instrument:
-            # Convert a Tinkoff API instrument to an SQLAlchemy instrument.
-            def api_to_db_datetime(dt: datetime) -> Optional[datetime]:
-                # Clear timezone info, return None instead of 1970.01.01
-                return dt.replace(tzinfo=None) if dt.timestamp() else None
-            db_instrument = db.Instrument()
-            vars(db_instrument).update(vars(api_instrument))
-            db_instrument.first_1min_candle_date = api_to_db_datetime(db_instrument.first_1min_candle_date)
-            db_instrument.first_1day_candle_date = api_to_db_datetime(db_instrument.first_1day_candle_date)
-            return db_instrument
+        async def save(asset_type: str, response: Any) -> None:
+            # Saves the instruments while the next responses are still being downloaded
+            nonlocal count
+            # Conversion of thousands of instruments would stall the event loop.
+            loop = asyncio.get_running_loop()
+            db_instruments = await loop.run_in_executor(None, _api_to_db_instruments, response.instruments)
+            count += len(db_instruments)
+            await self._db.add_instruments(asset_type, db_instruments)
 
         count = 0
         with codetiming.Timer(initial_text=f"Updating instruments...",
                               text=lambda elapsed: f"Updated {count} instruments in {elapsed:.2f}s.",
                               logger=logger.info):
-            async for asset_type, response in tapi.get_instruments(asset_types):
-                db_instruments = [api_to_db_instrument(api_instrument) for api_instrument in response.instruments]
-                count += len(db_instruments)
-                await self._db.add_instruments(asset_type, db_instruments)
+            save_tasks = []
+            status = ti.schemas.InstrumentStatus.INSTRUMENT_STATUS_ALL if full else ti.schemas.InstrumentStatus.INSTRUMENT_STATUS_BASE
+            async for asset_type, response in tapi.get_instruments(asset_types, status):
+                save_tasks.append(asyncio.create_task(save(asset_type, response)))
+            await asyncio.gather(*save_tasks)
 
 
     async def download_history(self, figis: Optional[Iterable[str]] = None) -> None:
@@ -75,16 +107,59 @@ class Host:
         """
 
         async def get_history_task(instrument, first_year):
-            uid_binary = str(instrument.uid).encode()
-            id_binary = str(instrument.id).encode()
-            db_tasks = []
-            async for csv in tapi.get_history_csvs(instrument.figi, first_year):
-                csv = csv.replace(uid_binary, id_binary)
-                csv = csv.replace(b';\n', b'\n')  # remove the trailing semicolon
-                db_tasks.append(asyncio.create_task(self._db.save_candle_history(csv)))
-            await asyncio.gather(*db_tasks)
-
-        tasks = []
-        async for instr, history_end in self._db.get_history_endings(figis):
-            tasks.append(asyncio.create_task(get_history_task(instr, history_end.year)))
-        await asyncio.gather(*tasks)
+            # Producer: downloads the history of one instrument and queues it for saving
+            # All of its CSVs go to the same writer, so that they are committed in order (see DB.connect()).
+            save_queue = save_queues[instrument.id % _HISTORY_SAVERS]
+            first = True  # the first year may overlap the saved history, the later ones can't
+            batch = bytearray()  # later years, saved in one COPY per batch
+            try:
+                async for csv in tapi.get_history_csvs(instrument.figi, first_year, str(instrument.uid), instrument.id):
+                    if first:
+                        await save_queue.put((csv, False))
+                        first = False
+                        continue
+                    batch += csv
+                    if len(batch) >= _HISTORY_BATCH_SIZE:
+                        await save_queue.put((batch, True))
+                        batch = bytearray()
+            except Exception as e:
+                # A failed instrument doesn't abandon the others; the years downloaded before the failure are still saved.
+                logger.error(f"{instrument} history download failed: {e!r}")
+            if batch:
+                await save_queue.put((batch, True))
+
+        async def download_task():
+            # Worker: downloads one instrument after another
+            while (item := await instrument_queue.get()) is not None:
+                await get_history_task(*item)
+
+        async def save_task(save_queue: asyncio.Queue[Optional[tuple[bytearray, bool]]]):
+            # Consumer: a bounded number of these keeps the database busy without queueing on the connection pool
+            while (item := await save_queue.get()) is not None:
+                csv, fast = item
+                await self._db.save_candle_history(csv, fast)
+
+        # No more workers than instruments, e.g. a single one for a single FIGI
+        downloaders = _HISTORY_DOWNLOADERS
+        if figis is not None:
+            figis = tuple(figis)
+            downloaders = min(downloaders, len(figis))
+
+        save_queues: list[asyncio.Queue[Optional[tuple[bytearray, bool]]]] = \
+            [asyncio.Queue(maxsize=_HISTORY_SAVE_QUEUE_SIZE // _HISTORY_SAVERS) for _ in range(_HISTORY_SAVERS)]
+        # A failed writer cancels everything at once, instead of leaving the downloads blocked on a full queue.
+        async with asyncio.TaskGroup() as save_tasks:
+            for save_queue in save_queues:
+                save_tasks.create_task(save_task(save_queue))
+            # The instruments are downloaded concurrently by a fixed number of workers, throttled by the API rate limit.
+            # The endings are read in full right away, so that the database stream doesn't stay open for the whole download.
+            instrument_queue: asyncio.Queue[Optional[tuple[db.Instrument, int]]] = asyncio.Queue()
+            async with asyncio.TaskGroup() as download_tasks:
+                for _ in range(downloaders):
+                    download_tasks.create_task(download_task())
+                async for history_ending in self._db.get_history_endings(figis):
+                    instrument_queue.put_nowait(history_ending)
+                for _ in range(downloaders):
+                    instrument_queue.put_nowait(None)
+            for save_queue in save_queues:
+                await save_queue.put(None)
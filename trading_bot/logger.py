@@ -1,8 +1,10 @@
 import logging
+import os
 import sys
+from typing import Callable, Optional
 
 logger = logging.getLogger(__name__)
-logger.level = logging.DEBUG
+logger.setLevel(os.environ.get('TRADING_BOT_LOG_LEVEL', 'DEBUG'))  # e.g. INFO to skip building the debug texts
 logger.addHandler(logging.StreamHandler(sys.stdout))
 logger.propagate = False  # don't duplicate to stderr
 
@@ -11,3 +13,8 @@ info = logger.info
 warning = logger.warning
 error = logger.error
 critical = logger.critical
+
+
+def debug_timer() -> Optional[Callable[[str], None]]:
+    """ The debug logger for codetiming.Timer, or None so that it skips formatting texts that won't be logged. """
+    return debug if logger.isEnabledFor(logging.DEBUG) else None
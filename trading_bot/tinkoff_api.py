@@ -1,15 +1,16 @@
 from __future__ import annotations
 
 import asyncio
-import concurrent.futures
 import contextlib
 import io
+import itertools
 import os
 import re
+import time
 import zipfile
 from asyncio import Task
 from datetime import datetime, timedelta
-from typing import Any, Optional, Iterable, AsyncGenerator
+from typing import Any, Optional, Iterable, AsyncGenerator, BinaryIO
 
 import aiohttp
 import aiohttp.web
@@ -38,8 +39,11 @@ _instrument_getters = {
 }
 
 _SECOND_CHANCE_PRIORITY = 1000000  # once-failed requests continue with a lower priority
+HISTORY_CONNECTIONS = 64  # concurrent HTTP connections for the history downloads
+_DOWNLOAD_CHUNK_SIZE = 1 << 18  # also the response read buffer, so that each chunk is read in one go
+_EXTRACT_CHUNK_SIZE = 1 << 20
+_HISTORY_LIMIT_PATTERN = re.compile(r'(?P<max1>[0-9]+).+?(?P<max2>[0-9]+).+?w=(?P<period>[0-9]+)')  # x-ratelimit-limit
 _token = os.environ['INVEST_TOKEN']
-_process_executor: Optional[concurrent.futures.ProcessPoolExecutor] = None  # for CPU-bound tasks
 _session: Optional[aiohttp.ClientSession] = None
 _history_api_lock = asyncio.Lock()
 
@@ -51,16 +55,22 @@ _history_limit_policy_updated: bool = False
 
 # Current history limits, updated after each HTTP response or by a timeout.
 _history_limit = 1
-_history_limit_timeout: datetime = datetime.now()
+_history_limit_timeout: float = time.monotonic()  # unaffected by system clock adjustments
 _history_limit_updated = asyncio.Event()
-_history_request_queue: asyncio.PriorityQueue[tuple[int, asyncio.Event]] = asyncio.PriorityQueue()
-_history_next_request_priority = 0  # earlier calls have highter priority
+# Entries are (priority, order, can_proceed); the unique order breaks ties, so events are never compared.
+_history_request_queue: asyncio.PriorityQueue[tuple[int, int, asyncio.Event]] = asyncio.PriorityQueue()
+_history_call_priorities = itertools.count()  # earlier calls have higher priority
+_history_request_order = itertools.count()
 _history_running_requests = 0
 
 
-async def get_instruments(_asset_types: Optional[Iterable[str]] = None) -> AsyncGenerator[tuple[str, Any]]:
+async def get_instruments(
+    _asset_types: Optional[Iterable[str]] = None,
+    instrument_status: ti.schemas.InstrumentStatus = ti.schemas.InstrumentStatus.INSTRUMENT_STATUS_ALL
+) -> AsyncGenerator[tuple[str, Any]]:
     """ Download instrument info.
 
+    :param instrument_status: INSTRUMENT_STATUS_BASE filters out, on the server, the instruments not tradable via the API
     :return: Pairs of instrument info and API response
     """
     async def instrument_get_task(asset_type: str, getter_name: str) -> tuple[str, Any]:
@@ -69,7 +79,7 @@ async def get_instruments(_asset_types: Optional[Iterable[str]] = None) -> Async
         with codetiming.Timer(initial_text=f"Requesting {getter_name}...",
                               text=lambda elapsed: f"Received {count} {getter_name} in {elapsed:.2f}s.",
                               logger=logger.debug):
-            response = await getter(instrument_status=ti.schemas.InstrumentStatus.INSTRUMENT_STATUS_ALL)
+            response = await getter(instrument_status=instrument_status)
             count = len(response.instruments)
         return asset_type, response
 
@@ -81,23 +91,24 @@ async def get_instruments(_asset_types: Optional[Iterable[str]] = None) -> Async
             yield await task
 
 
-async def get_history_csvs(figi: str, first_year: int) -> AsyncGenerator[bytearray]:
+async def get_history_csvs(figi: str, first_year: int, uid: str, instrument_id: int) -> AsyncGenerator[bytearray]:
     """ Download CSV candle history.
 
     :param figi: Instrument to download
     :param first_year: First year to download
-    :return: A generator of bytearrays of the downloaded CSVs
+    :param uid: Instrument UID, as it appears in the CSVs
+    :param instrument_id: Replacement for the UID in the returned CSVs
+    :return: A generator of bytearrays of the downloaded CSVs, without the trailing semicolons
     """
 
     # The main problem is to throttle requests by x-ratelimit-limit
     # Each instance of a function call adds its can_proceed event to the _history_request_queue priority queue.
-    # Earlier calls have higher priority, accordingly to _history_request_priority.
+    # Earlier calls have higher priority, accordingly to _history_call_priorities.
     # _history_limit_loop() keeps tack of the request limit and fires the events accordingly.
     # Each HTTP response puts the next year request in the queue and updates the request limit info.
     # A 404 Not Found response means end of history. Any other error gives a second chance.
     # A failed second chance is logged as a warning and considered end of history.
 
-    global _history_next_request_priority
     global _history_limit
     global _history_limit_max
     global _history_limit_period
@@ -105,114 +116,175 @@ async def get_history_csvs(figi: str, first_year: int) -> AsyncGenerator[bytearr
     global _history_limit_timeout
     global _history_limit_watcher_task
     global _history_running_requests
-    global _process_executor
-    global _session
 
     try:
         async with _history_api_lock:
             _history_running_requests += 1
             if not _history_limit_watcher_task:
                 _history_limit_watcher_task = asyncio.create_task(_history_limit_watcher())
-            if not _session:
-                _session =  aiohttp.ClientSession(headers={'Authorization': 'Bearer ' + _token})
-            if not _process_executor:
-                _process_executor = concurrent.futures.ProcessPoolExecutor()
+            session = _get_session()
 
         year = first_year
-        downloaded_count = 0
+        downloaded_years: list[int] = []  # logged once per FIGI rather than a line per request
         can_proceed = asyncio.Event()
-        priority = _history_next_request_priority
-        _history_next_request_priority += 1  # continuous numeration of all requests for the current program run
+        priority = next(_history_call_priorities)  # continuous numeration of all calls for the current program run
         first_chance_failed = False
+        extraction: Optional[asyncio.Future[bytearray]] = None  # the previous year, unzipped during the next download
         loop = asyncio.get_event_loop()
-
-        with codetiming.Timer(initial_text=f"Downloading history of {figi}, starting with {first_year}...",
-                              text=lambda elapsed: f"Downloaded {downloaded_count} years of {figi} in {elapsed:.2f}s.",
-                              logger=logger.debug):
-            while year <= datetime.now().year:
-                can_proceed.clear()
-                _history_request_queue.put_nowait((priority, can_proceed))
-                await can_proceed.wait()
-
-                logger.debug(f"{figi} {year} requested.")
-                async with _session.get(f'https://invest-public-api.tinkoff.ru/history-data?figi={figi}&year={year}') as response:
-                    # History request limits, updated once
-                    if not _history_limit_policy_updated and 'x-ratelimit-limit' in response.headers:
-                        match = re.fullmatch(r'(?P<max1>[0-9]+).+?(?P<max2>[0-9]+).+?w=(?P<period>[0-9]+)',
-                                             response.headers['x-ratelimit-limit'])
-                        _history_limit_max = min(int(match.group('max1')), int(match.group('max2')))
-                        _history_limit_period = timedelta(seconds=int(match.group('period')))
-                        _history_limit_policy_updated = True
-
-                        # Remaining requests
-                        if 'x-ratelimit-remaining' in response.headers:
-                            _history_limit = max(_history_limit, int(response.headers['x-ratelimit-remaining']))
-                            _history_limit_updated.set()
-
-                    # Remaining request limit timeout
-                    if 'x-ratelimit-reset' in response.headers:
-                        limit_timeout_seconds = int(response.headers['x-ratelimit-reset'])
-                        limit_timeout = datetime.now() + timedelta(seconds=limit_timeout_seconds)
-                        if limit_timeout < _history_limit_timeout:
-                            _history_limit_timeout = limit_timeout
-                            _history_limit_updated.set()
-
-                    # OK
-                    if response.ok:
-                        if first_chance_failed:
-                            first_chance_failed = False
-                            priority -= _SECOND_CHANCE_PRIORITY
-                        # Unzip in a parallel process.
-                        zip_data = await response.content.read()
-                        yield await loop.run_in_executor(_process_executor, _extract, zip_data)
-                        downloaded_count += 1
-                        logger.debug(f"{figi} {year} received.")
-                        if year == datetime.now().year:
+        uid_binary = uid.encode()
+        id_binary = str(instrument_id).encode()
+
+        timer_logger = logger.debug_timer()
+        with codetiming.Timer(initial_text=f"Downloading history of {figi}, starting with {first_year}..." if timer_logger else False,
+                              text=lambda elapsed: f"Downloaded {len(downloaded_years)} years of {figi} "
+                                                   f"({', '.join(map(str, downloaded_years))}) in {elapsed:.2f}s.",
+                              logger=timer_logger):
+            try:
+                while year <= datetime.now().year:
+                    can_proceed.clear()
+                    _history_request_queue.put_nowait((priority, next(_history_request_order), can_proceed))
+                    await can_proceed.wait()
+
+                    async with session.get(f'https://invest-public-api.tinkoff.ru/history-data?figi={figi}&year={year}') as response:
+                        # History request limits, updated once
+                        if not _history_limit_policy_updated and 'x-ratelimit-limit' in response.headers:
+                            match = _HISTORY_LIMIT_PATTERN.fullmatch(response.headers['x-ratelimit-limit'])
+                            _history_limit_max = min(int(match.group('max1')), int(match.group('max2')))
+                            _history_limit_period = timedelta(seconds=int(match.group('period')))
+                            _history_limit_policy_updated = True
+
+                            # Remaining requests
+                            if 'x-ratelimit-remaining' in response.headers:
+                                _history_limit = max(_history_limit, int(response.headers['x-ratelimit-remaining']))
+                                _history_limit_updated.set()
+
+                        # Remaining request limit timeout
+                        if 'x-ratelimit-reset' in response.headers:
+                            limit_timeout_seconds = int(response.headers['x-ratelimit-reset'])
+                            limit_timeout = time.monotonic() + limit_timeout_seconds
+                            if limit_timeout < _history_limit_timeout:
+                                _history_limit_timeout = limit_timeout
+                                _history_limit_updated.set()
+
+                        # OK
+                        if response.ok:
+                            if first_chance_failed:
+                                first_chance_failed = False
+                                priority -= _SECOND_CHANCE_PRIORITY
+                            zip_data = await _read_body(response)
+                            # Yielded one year behind, so that unzipping overlaps the next download.
+                            if extraction:
+                                previous_year, extraction = extraction, None
+                                yield await previous_year
+                            # Unzip and rewrite in the loop's default thread pool: zlib runs without the GIL,
+                            # and no data is pickled to another process.
+                            extraction = loop.run_in_executor(None, _extract, zip_data, uid_binary, id_binary)
+                            downloaded_years.append(year)
+                            if year == datetime.now().year:
+                                break
+                            year += 1
+                            continue
+
+                        # End of history
+                        if response.status == aiohttp.web.HTTPNotFound.status_code:
+                            logger.debug(f"{figi} history ended at {year-1}.")
                             break
-                        year += 1
-                        continue
-
-                    # End of history
-                    if response.status == aiohttp.web.HTTPNotFound.status_code:
-                        logger.debug(f"{figi} history ended at {year-1}.")
-                        break
 
-                    message = response.headers.get('message', f"{response.reason}, no message")
+                        message = response.headers.get('message', f"{response.reason}, no message")
 
-                    # Second chance failed, exit.
-                    if first_chance_failed:
-                        logger.logger.error(f"{figi} {year}: {message}")
-                        break
+                        # Second chance failed, exit.
+                        if first_chance_failed:
+                            logger.logger.error(f"{figi} {year}: {message}")
+                            break
 
-                    # First chance failed, retry with a lower priority
-                    logger.logger.warning(f"{figi} {year}: {message}")
-                    first_chance_failed = True
-                    priority += _SECOND_CHANCE_PRIORITY  # retry at the end
+                        # First chance failed, retry with a lower priority
+                        logger.logger.warning(f"{figi} {year}: {message}")
+                        first_chance_failed = True
+                        priority += _SECOND_CHANCE_PRIORITY  # retry at the end
+            except Exception:
+                # The previous year was downloaded in full, so it's still returned before the failure.
+                if extraction:
+                    yield await extraction
+                raise
+
+            if extraction:
+                yield await extraction
     finally:
         # The last one to leave, turn off the lights.
         async with _history_api_lock:
             _history_running_requests -= 1
             if _history_running_requests == 0:
-                if _session:
-                    await _session.close()
-                    _session = None
                 if _history_limit_watcher_task:
                     _history_limit_watcher_task.cancel()
                     with contextlib.suppress(asyncio.CancelledError):
                         await _history_limit_watcher_task
                     _history_limit_watcher_task = None
-                if _process_executor:
-                    _process_executor.shutdown()
-                    _process_executor = None
                 logger.debug("Tinkoff history API shut down.")
 
 
-def _extract(zip_data: bytes) -> bytearray:
-    """ Unzip worker, called in a parallel process. """
-    result = bytearray()
-    with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
-        for csv_name in zip_file.namelist():
-            result.extend(zip_file.read(csv_name))
+async def close() -> None:
+    """ Close the HTTP session shared by the history downloads, if one was opened. """
+    global _session
+    async with _history_api_lock:
+        if _session:
+            await _session.close()
+            _session = None
+            logger.debug("Tinkoff history session closed.")
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """ Get the HTTP session shared by all history requests, creating it in the running event loop.
+
+    It stays open until close(), so that the connections outlive the gaps between the downloads.
+    """
+    global _session
+    if not _session:
+        # Connections stay open between the bursts released by the rate limiter.
+        connector = aiohttp.TCPConnector(limit=HISTORY_CONNECTIONS, ttl_dns_cache=600, keepalive_timeout=60)
+        # Large years may take long to download, so only stalls are timed out.
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        _session = aiohttp.ClientSession(headers={'Authorization': 'Bearer ' + _token}, connector=connector, timeout=timeout,
+                                         read_bufsize=_DOWNLOAD_CHUNK_SIZE)
+    return _session
+
+
+async def _read_body(response: aiohttp.ClientResponse) -> io.BytesIO:
+    """ Read a response body in chunks into a file object, ready to be unzipped without another copy. """
+    result = io.BytesIO()
+    async for chunk in response.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+        result.write(chunk)
+    result.seek(0)
+    return result
+
+
+def _extract(zip_data: BinaryIO, uid: bytes, instrument_id: bytes) -> bytearray:
+    """ Unzip worker, called in a parallel thread.
+
+    Replaces the UIDs at the line starts with the instrument ID and removes the trailing semicolons.
+    """
+    with zipfile.ZipFile(zip_data) as zip_file:
+        # Decompress in chunks straight into a preallocated buffer, without a full copy of each CSV.
+        members = zip_file.infolist()
+        result = bytearray(sum(member.file_size for member in members))
+        offset = 0
+        with memoryview(result) as view:
+            for member in members:
+                with zip_file.open(member) as csv_file:
+                    while count := csv_file.readinto(view[offset:offset + _EXTRACT_CHUNK_SIZE]):
+                        offset += count
+    del result[offset:]  # in case the sizes in the archive were overstated
+    if not result:
+        return result
+    # The first line is overwritten blindly below, so a CSV of another instrument would be silently corrupted.
+    if not result.startswith(uid):
+        raise ValueError(f"History CSV starts with {bytes(result[:len(uid)])!r} instead of the UID {uid!r}")
+
+    # Every line is 'uid;...;\n', so each ';\n' + uid pair is replaced in one pass.
+    # The ID is padded with zeros to the UID length, so the first line is rewritten in place.
+    result = result.replace(b';\n' + uid, b'\n' + instrument_id)
+    result[:len(uid)] = instrument_id.rjust(len(uid), b'0')
+    if result.endswith(b';\n'):
+        del result[-2]
     return result
 
 
@@ -220,22 +292,22 @@ async def _history_limit_watcher() -> None:
     """ Manage history request limit in an infinite parallel loop. """
     global _history_limit
     global _history_limit_timeout
-    _history_limit_timeout = datetime.now() + _history_limit_period
+    _history_limit_timeout = time.monotonic() + _history_limit_period.total_seconds()
 
     while True:  # will be cancelled from the outside (asyncio.CancelledError)
         while _history_limit > 0:
-            _, event = await _history_request_queue.get()
+            _, _, event = await _history_request_queue.get()
             event.set()
             _history_limit -= 1
 
-        wait_period = _history_limit_timeout - datetime.now()
-        if wait_period > timedelta(0):
+        wait_period = _history_limit_timeout - time.monotonic()
+        if wait_period > 0:
             with contextlib.suppress(asyncio.TimeoutError):
-                logger.debug(f"{_history_limit_watcher.__name__}(): Waiting for {wait_period.total_seconds():.2f}s.")
-                await asyncio.wait_for(_history_limit_updated.wait(), wait_period.total_seconds())
+                logger.debug(f"{_history_limit_watcher.__name__}(): Waiting for {wait_period:.2f}s.")
+                await asyncio.wait_for(_history_limit_updated.wait(), wait_period)
                 if _history_limit_updated.is_set():
                     logger.debug(f"{_history_limit_watcher.__name__}(): Woke up to update the timeout.")
         _history_limit_updated.clear()
-        while _history_limit_timeout <= datetime.now():
+        while _history_limit_timeout <= time.monotonic():
             _history_limit = _history_limit_max
-            _history_limit_timeout += _history_limit_period
+            _history_limit_timeout += _history_limit_period.total_seconds()
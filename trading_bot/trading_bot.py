@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
 import asyncio
+from typing import Final, Optional
 
 import codetiming
 
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
+
+import logger
 from host import Host
 
+# Instruments to download the history of, e.g. frozenset({'BBG000BCSST7', 'BBG004731354'}); None for all known.
+HISTORY_FIGIS: Final[Optional[frozenset[str]]] = None
+
 
 async def main() -> None:
-    with codetiming.Timer(text="Total running time: {:.2f} s"):
-        async with Host() as host:
-            #await host.deploy()
-            #await host.update_instruments()
-            await host.download_history()
+    async with Host() as host:
+        #await host.deploy()
+        #await host.update_instruments()
+        await host.download_history(HISTORY_FIGIS)
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    # Timed from outside the event loop, so that its setup and shutdown are counted too.
+    with codetiming.Timer(text="Total running time: {:.2f} s", logger=logger.info):
+        if uvloop:
+            uvloop.run(main())  # a libuv event loop, faster sockets for the HTTP and gRPC clients
+        else:
+            asyncio.run(main())
\ No newline at end of file